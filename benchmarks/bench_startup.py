@@ -0,0 +1,85 @@
+"""Startup-time benchmark: module import cost and first-render latency of main.py.
+
+Each measurement runs in a fresh interpreter so it reflects a cold start.
+
+    python benchmarks/bench_startup.py [--runs 5]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["rate_limiter", "file_processing", "utils", "pinecone_integration", "job_queue", "main"]
+
+# Libraries that should only be loaded when a feature actually needs them
+LAZY_MODULES = ["docx", "PyPDF2", "pandas", "openpyxl", "openai", "pinecone"]
+
+IMPORT_SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+RENDER_SNIPPET = """
+import time, json
+from streamlit.testing.v1 import AppTest
+start = time.perf_counter()
+at = AppTest.from_file("main.py", default_timeout=120)
+at.secrets["OPENAI_API_KEY"] = "bench"
+at.secrets["PINECONE_API_KEY"] = "bench"
+at.secrets["PINECONE_ENVIRONMENT"] = "bench"
+at.secrets["PINECONE_INDEX_NAME"] = "bench"
+at.secrets["JOB_WORKERS"] = 0
+at.run()
+print(json.dumps({"seconds": time.perf_counter() - start, "exceptions": len(at.exception)}))
+"""
+
+
+def run_snippet(snippet):
+    result = subprocess.run([sys.executable, "-c", snippet], cwd=REPO_ROOT,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def bench_imports(runs):
+    for module in MODULES:
+        try:
+            samples = [run_snippet(IMPORT_SNIPPET.format(module=module, lazy=LAZY_MODULES)) for _ in range(runs)]
+        except RuntimeError as e:
+            print(f"import {module:<22} skipped ({e})")
+            continue
+        median_ms = statistics.median(s["seconds"] for s in samples) * 1000
+        loaded = ", ".join(samples[0]["loaded"]) or "none"
+        print(f"import {module:<22} {median_ms:8.1f} ms   heavy libs loaded: {loaded}")
+
+
+def bench_first_render(runs):
+    try:
+        samples = [run_snippet(RENDER_SNIPPET) for _ in range(runs)]
+    except RuntimeError as e:
+        print(f"first render                  skipped ({e})")
+        return
+    median_ms = statistics.median(s["seconds"] for s in samples) * 1000
+    print(f"first render                  {median_ms:8.1f} ms   script exceptions: {samples[0]['exceptions']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per measurement (median is reported)")
+    args = parser.parse_args()
+
+    print(f"Python {sys.version.split()[0]}, {args.runs} run(s) per measurement")
+    bench_imports(args.runs)
+    bench_first_render(args.runs)
+
+
+if __name__ == "__main__":
+    main()
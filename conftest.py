@@ -0,0 +1 @@
+# Lets a plain `pytest` run from the repo root import the top-level modules (job_queue, utils, ...)
@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import array
+import sqlite3
+import hashlib
+import logging
+
+from utils import get_embedding, answer_question, answer_error
+
+logger = logging.getLogger(__name__)
+
+EVIDENCE_DB_PATH = os.environ.get("DUE_EVIDENCE_DB", "evidence.db")
+EVIDENCE_TOP_K = 3  # Matches the number of documents used by "Ask a Question"
+CLAIM_LEASE = 300  # Seconds a worker may hold a question while refreshing it
+CLAIM_POLL_INTERVAL = 0.5  # Seconds between checks while waiting on another worker's refresh
+
+# Each saved questionnaire question gets a row holding its top evidence chunks
+# and a draft answer. A row is stale when a document was added or deleted after
+# it was last refreshed (invalidated_at > refreshed_at); missing rows are stale too.
+# A worker claims a question in refresh_claims before refreshing it, so report and
+# precompute jobs running at the same time don't both pay to re-answer it.
+
+
+def _connect(db_path=None):
+    conn = sqlite3.connect(db_path or EVIDENCE_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def init_db(db_path=None):
+    conn = _connect(db_path)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS question_evidence (
+                questionnaire_id TEXT NOT NULL,
+                question_key TEXT NOT NULL,
+                question TEXT NOT NULL,
+                question_embedding BLOB NOT NULL,
+                evidence TEXT NOT NULL,
+                min_score REAL,
+                draft TEXT NOT NULL,
+                refreshed_at REAL NOT NULL,
+                invalidated_at REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (questionnaire_id, question_key)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS evidence_refs (
+                questionnaire_id TEXT NOT NULL,
+                question_key TEXT NOT NULL,
+                document_id TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS refresh_claims (
+                questionnaire_id TEXT NOT NULL,
+                question_key TEXT NOT NULL,
+                claimed_until REAL NOT NULL,
+                PRIMARY KEY (questionnaire_id, question_key)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_evidence_refs_doc ON evidence_refs (document_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_evidence_refs_question ON evidence_refs (questionnaire_id, question_key)")
+    finally:
+        conn.close()
+
+
+def question_key(question):
+    return hashlib.sha256(question["question"].strip().encode("utf-8")).hexdigest()
+
+
+def matches_questions(saved_questions, questions):
+    # Only a questionnaire identical to the saved one may use (and write to) its index rows
+    return [question_key(q) for q in saved_questions] == [question_key(q) for q in questions]
+
+
+def _encode_embedding(embedding):
+    # float32 BLOBs are ~4x smaller than JSON and load without parsing
+    return array.array("f", embedding).tobytes()
+
+
+def _decode_embedding(value):
+    # Rows written before embeddings were stored as BLOBs hold JSON text
+    if isinstance(value, str):
+        return json.loads(value)
+    return array.array("f", value).tolist()
+
+
+def _unit_rows(np, vectors):
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _is_fresh(row):
+    return row is not None and row["invalidated_at"] <= row["refreshed_at"]
+
+
+def _load_row(conn, questionnaire_id, key):
+    return conn.execute(
+        "SELECT * FROM question_evidence WHERE questionnaire_id = ? AND question_key = ?", (questionnaire_id, key)
+    ).fetchone()
+
+
+def _claim(conn, questionnaire_id, key):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT claimed_until FROM refresh_claims WHERE questionnaire_id = ? AND question_key = ?",
+            (questionnaire_id, key)
+        ).fetchone()
+        claimed = row is None or row["claimed_until"] < now
+        if claimed:
+            conn.execute(
+                "INSERT OR REPLACE INTO refresh_claims (questionnaire_id, question_key, claimed_until) VALUES (?, ?, ?)",
+                (questionnaire_id, key, now + CLAIM_LEASE)
+            )
+        conn.execute("COMMIT")
+        return claimed
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _release(conn, questionnaire_id, key):
+    conn.execute("DELETE FROM refresh_claims WHERE questionnaire_id = ? AND question_key = ?", (questionnaire_id, key))
+
+
+def _refresh_question(conn, pinecone_connection, questionnaire_id, question, row):
+    key = question_key(question)
+    started_at = time.time()
+    try:
+        # The question text is part of the key, so a stored embedding is still valid
+        embedding = _decode_embedding(row["question_embedding"]) if row is not None else get_embedding(question["question"])
+        similar_docs = pinecone_connection.get_similar_documents(embedding, top_k=EVIDENCE_TOP_K)
+        evidence = [{"id": doc_id, "title": title, "score": score} for doc_id, title, _, score in similar_docs]
+        context = "\n".join([text for _, _, text, _ in similar_docs])
+        draft = answer_question(question, context)
+    except Exception as e:
+        # Keep the error visible in the report; nothing is stored, so the question stays stale
+        return answer_error(question, e)
+    draft["evidence"] = evidence
+
+    # get_similar_documents returns [] on errors as well as for an empty Knowledge Base,
+    # so a draft without evidence is stored but left stale to be retried next time
+    refreshed_at = started_at if evidence else -1
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO question_evidence (questionnaire_id, question_key, question, question_embedding, "
+            "evidence, min_score, draft, refreshed_at, invalidated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE((SELECT invalidated_at FROM question_evidence "
+            "WHERE questionnaire_id = ? AND question_key = ?), 0))",
+            (questionnaire_id, key, question["question"], _encode_embedding(embedding), json.dumps(evidence),
+             min(doc["score"] for doc in evidence) if len(evidence) >= EVIDENCE_TOP_K else None,
+             json.dumps(draft), refreshed_at, questionnaire_id, key)
+        )
+        conn.execute("DELETE FROM evidence_refs WHERE questionnaire_id = ? AND question_key = ?", (questionnaire_id, key))
+        conn.executemany(
+            "INSERT INTO evidence_refs (questionnaire_id, question_key, document_id) VALUES (?, ?, ?)",
+            [(questionnaire_id, key, doc["id"]) for doc in evidence]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return draft
+
+
+def _get_or_refresh(conn, pinecone_connection, questionnaire_id, question, wait_for_others):
+    # Returns (report_item, refreshed); report_item is None if skipped because another worker holds it
+    key = question_key(question)
+    while True:
+        row = _load_row(conn, questionnaire_id, key)
+        if _is_fresh(row):
+            return json.loads(row["draft"]), False
+        if _claim(conn, questionnaire_id, key):
+            try:
+                return _refresh_question(conn, pinecone_connection, questionnaire_id, question, row), True
+            finally:
+                _release(conn, questionnaire_id, key)
+        if not wait_for_others:
+            return None, False
+        time.sleep(CLAIM_POLL_INTERVAL)
+
+
+def refresh_questionnaire(pinecone_connection, questionnaire_id, questions, progress_bar=None,
+                          wait_for_others=True, prune=False, db_path=None):
+    """Bring a questionnaire's evidence up to date and return its report items.
+
+    Only questions that are new or whose evidence was invalidated are
+    re-retrieved and re-answered; the rest are read straight from the index.
+    A question another worker is refreshing is waited for, or skipped (its
+    item is None) with wait_for_others=False. prune=True drops rows for
+    questions no longer in the questionnaire; only pass it with the saved
+    questions, never an edited copy.
+    """
+    conn = _connect(db_path)
+    try:
+        report = []
+        refreshed = 0
+        for i, question in enumerate(questions):
+            item, did_refresh = _get_or_refresh(conn, pinecone_connection, questionnaire_id, question, wait_for_others)
+            report.append(item)
+            refreshed += did_refresh
+            if progress_bar is not None:
+                progress_bar.progress((i + 1) / len(questions))
+
+        if prune:
+            current_keys = {question_key(question) for question in questions}
+            stored_keys = [row["question_key"] for row in conn.execute(
+                "SELECT question_key FROM question_evidence WHERE questionnaire_id = ?", (questionnaire_id,)
+            )]
+            removed = [(questionnaire_id, key) for key in stored_keys if key not in current_keys]
+            if removed:
+                conn.executemany("DELETE FROM question_evidence WHERE questionnaire_id = ? AND question_key = ?", removed)
+                conn.executemany("DELETE FROM evidence_refs WHERE questionnaire_id = ? AND question_key = ?", removed)
+
+        logger.info(f"Evidence for questionnaire {questionnaire_id}: {refreshed} of {len(questions)} question(s) refreshed")
+        return report
+    finally:
+        conn.close()
+
+
+def document_added(document_id, embedding, db_path=None):
+    """Invalidate questions the new document could enter the top evidence for."""
+    return documents_added([(document_id, embedding)], db_path)
+
+
+def documents_added(documents, db_path=None):
+    """Invalidate questions any of the new (document_id, embedding) pairs could enter the top evidence for.
+
+    Pass all chunks of a file at once: the stored question embeddings are
+    loaded once and compared against every chunk in a single matrix product.
+    """
+    if not documents:
+        return 0
+    conn = _connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT questionnaire_id, question_key, question_embedding, min_score FROM question_evidence"
+        ).fetchall()
+        # Questions with fewer than EVIDENCE_TOP_K evidence documents take any new document
+        affected = [(row["questionnaire_id"], row["question_key"]) for row in rows if row["min_score"] is None]
+        scored = [row for row in rows if row["min_score"] is not None]
+        if scored:
+            import numpy as np
+            questions = _unit_rows(np, [_decode_embedding(row["question_embedding"]) for row in scored])
+            chunks = _unit_rows(np, [embedding for _, embedding in documents])
+            best_scores = (questions @ chunks.T).max(axis=1)
+            affected += [
+                (row["questionnaire_id"], row["question_key"])
+                for row, score in zip(scored, best_scores) if score >= row["min_score"]
+            ]
+        if affected:
+            now = time.time()
+            conn.executemany(
+                "UPDATE question_evidence SET invalidated_at = ? WHERE questionnaire_id = ? AND question_key = ?",
+                [(now, questionnaire_id, key) for questionnaire_id, key in affected]
+            )
+        logger.info(f"Adding {len(documents)} document(s) invalidated evidence for {len(affected)} question(s)")
+        return len(affected)
+    finally:
+        conn.close()
+
+
+def document_deleted(document_id, db_path=None):
+    """Invalidate questions that cited the deleted document as evidence."""
+    return documents_deleted([document_id], db_path)
+
+
+def documents_deleted(document_ids, db_path=None):
+    """Invalidate questions that cited any of the deleted documents (e.g. all chunks of a file)."""
+    conn = _connect(db_path)
+    try:
+        conn.execute("CREATE TEMP TABLE deleted_documents (document_id TEXT PRIMARY KEY)")
+        conn.executemany("INSERT OR IGNORE INTO deleted_documents (document_id) VALUES (?)",
+                         [(document_id,) for document_id in document_ids])
+        cursor = conn.execute(
+            "UPDATE question_evidence SET invalidated_at = ? WHERE (questionnaire_id, question_key) IN "
+            "(SELECT questionnaire_id, question_key FROM evidence_refs "
+            "WHERE document_id IN (SELECT document_id FROM deleted_documents))",
+            (time.time(),)
+        )
+        logger.info(f"Deleting {len(document_ids)} document(s) invalidated evidence for {cursor.rowcount} question(s)")
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def forget_questionnaire(questionnaire_id, db_path=None):
+    conn = _connect(db_path)
+    try:
+        conn.execute("DELETE FROM question_evidence WHERE questionnaire_id = ?", (questionnaire_id,))
+        conn.execute("DELETE FROM evidence_refs WHERE questionnaire_id = ?", (questionnaire_id,))
+        conn.execute("DELETE FROM refresh_claims WHERE questionnaire_id = ?", (questionnaire_id,))
+    finally:
+        conn.close()
@@ -1,7 +1,160 @@
 import io
-import docx
-import PyPDF2
-import pandas as pd
+import math
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Format libraries are imported inside the branch that needs them so that
+# importing this module (and first page load) doesn't pay for all of them.
+
+# Tables are split into blocks of rows, each embedded and stored on its own.
+# The char limit keeps wide sheets within the embedding and Pinecone metadata limits.
+TABLE_ROWS_PER_CHUNK = 50
+TABLE_CHUNK_MAX_CHARS = 6000
+
+def _format_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        if value.is_integer():
+            return str(int(value))
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time(0):
+        return value.date().isoformat()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    # "|" separates cells, so escape it inside values
+    return " ".join(str(value).split()).replace("|", "\\|")
+
+def _format_row(row):
+    cells = [_format_cell(value) for value in row]
+    while cells and not cells[-1]:
+        cells.pop()
+    return " | ".join(cells)
+
+def _table_chunks(source, rows):
+    """Turn an iterable of rows into compact row-block chunks.
+
+    The first non-empty row is treated as the header and repeated at the top
+    of every chunk, so each block can be understood (and retrieved) on its own.
+    Yields dicts with a "label" (source and row range) and the chunk "text".
+    """
+    header = None
+    block = []
+    block_chars = 0
+    first_row = None
+
+    def make_chunk(last_row):
+        label = f"{source}, row {first_row}" if first_row == last_row else f"{source}, rows {first_row}-{last_row}"
+        return {"label": label, "text": f"{label}\n{header}\n" + "\n".join(block)}
+
+    for row_number, row in enumerate(rows, 1):
+        line = _format_row(row)
+        if not line.replace("|", "").strip():
+            continue
+        if header is None:
+            header = line
+            continue
+        if block and (len(block) >= TABLE_ROWS_PER_CHUNK or block_chars + len(line) > TABLE_CHUNK_MAX_CHARS):
+            yield make_chunk(last_row)
+            block = []
+            block_chars = 0
+        if not block:
+            first_row = row_number
+        block.append(line)
+        block_chars += len(line) + 1
+        last_row = row_number
+
+    if block:
+        yield make_chunk(last_row)
+    elif header is not None:
+        # Header-only table
+        yield {"label": source, "text": f"{source}\n{header}"}
+
+def _iter_xlsx_tables(data):
+    import openpyxl
+    # Read-only mode streams rows instead of loading the whole workbook into memory
+    workbook = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield from _table_chunks(f"Sheet {sheet.title}", sheet.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+def _iter_xls_tables(data):
+    # openpyxl can't read the legacy .xls format, so fall back to pandas
+    import pandas as pd
+    sheets = pd.read_excel(io.BytesIO(data), sheet_name=None, header=None)
+    for sheet_name, df in sheets.items():
+        yield from _table_chunks(f"Sheet {sheet_name}", df.itertuples(index=False, name=None))
+
+def _outside_bboxes(bboxes):
+    def keep(obj):
+        if "x0" not in obj or "top" not in obj:
+            return True
+        x = (obj["x0"] + obj["x1"]) / 2
+        y = (obj["top"] + obj["bottom"]) / 2
+        return not any(x0 <= x <= x1 and top <= y <= bottom for x0, top, x1, bottom in bboxes)
+    return keep
+
+def _extract_pdf_with_tables(data):
+    """Return (text, table_chunks) for a PDF.
+
+    Table regions are cut out of the page text so each table is embedded only
+    once, as row-block chunks. pdfplumber is optional; without it PDFs are
+    extracted as plain text with no table chunks.
+    """
+    try:
+        import pdfplumber
+    except ImportError:
+        logger.info("pdfplumber is not installed; skipping PDF table extraction")
+        return _extract_pdf_text(data), []
+
+    texts = []
+    table_chunks = []
+    with pdfplumber.open(io.BytesIO(data)) as pdf:
+        for page_number, page in enumerate(pdf.pages, 1):
+            tables = page.find_tables()
+            if tables:
+                page_text = page.filter(_outside_bboxes([table.bbox for table in tables])).extract_text()
+            else:
+                page_text = page.extract_text()
+            texts.append(page_text or "")
+            for table_number, table in enumerate(tables, 1):
+                table_chunks.extend(_table_chunks(f"Page {page_number} table {table_number}", table.extract()))
+    return "\n".join(texts), table_chunks
+
+def _extract_pdf_text(data):
+    import PyPDF2
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(data))
+    return "\n".join([page.extract_text() for page in pdf_reader.pages])
+
+def extract_chunks_from_file(file):
+    """Extract a file as a list of {"label", "text"} chunks for the Knowledge Base.
+
+    Spreadsheets (every sheet) and tables found in PDFs become row-block chunks;
+    other content is a single chunk with no label.
+    """
+    try:
+        file_extension = file.name.split('.')[-1].lower()
+        if file_extension == 'xlsx':
+            return list(_iter_xlsx_tables(file.getvalue()))
+        elif file_extension == 'xls':
+            return list(_iter_xls_tables(file.getvalue()))
+        elif file_extension == 'pdf':
+            text, table_chunks = _extract_pdf_with_tables(file.getvalue())
+            if text.strip() or not table_chunks:
+                return [{"label": None, "text": text}] + table_chunks
+            return table_chunks
+        else:
+            return [{"label": None, "text": extract_text_from_file(file)}]
+    except ValueError:
+        raise
+    except Exception as e:
+        logger.error(f"Error extracting chunks from file: {str(e)}")
+        raise ValueError(f"Error extracting text from file: {str(e)}")
 
 def extract_text_from_file(file):
     try:
@@ -9,14 +162,15 @@ def extract_text_from_file(file):
         if file_extension == 'txt':
             return file.getvalue().decode("utf-8")
         elif file_extension == 'docx':
+            import docx
             doc = docx.Document(io.BytesIO(file.getvalue()))
             return "\n".join([paragraph.text for paragraph in doc.paragraphs])
         elif file_extension == 'pdf':
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(file.getvalue()))
-            return "\n".join([page.extract_text() for page in pdf_reader.pages])
-        elif file_extension in ['xlsx', 'xls']:
-            df = pd.read_excel(io.BytesIO(file.getvalue()))
-            return df.to_string(index=False)
+            return _extract_pdf_text(file.getvalue())
+        elif file_extension == 'xlsx':
+            return "\n\n".join(chunk["text"] for chunk in _iter_xlsx_tables(file.getvalue()))
+        elif file_extension == 'xls':
+            return "\n\n".join(chunk["text"] for chunk in _iter_xls_tables(file.getvalue()))
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
     except Exception as e:
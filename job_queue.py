@@ -0,0 +1,519 @@
+import os
+import io
+import json
+import time
+import uuid
+import base64
+import sqlite3
+import hashlib
+import logging
+import threading
+import multiprocessing
+
+from utils import get_secret
+from rate_limiter import get_rate_limiter, set_quota_share, worker_quota_shares
+import evidence_index
+
+logger = logging.getLogger(__name__)
+
+JOB_DB_PATH = os.environ.get("DUE_JOB_DB", "jobs.db")
+POLL_INTERVAL = 1.0  # Seconds an idle worker waits before checking for new jobs
+HEARTBEAT_INTERVAL = 10  # Seconds between liveness updates for a running job
+STALE_JOB_TIMEOUT = 60  # A running job with no heartbeat for this long is treated as dead
+MAX_ATTEMPTS = 3  # Jobs whose worker keeps dying (e.g. OOM on a huge file) are failed after this
+SUPERVISOR_INTERVAL = 5  # Seconds between checks for dead worker processes
+METRICS_INTERVAL = 10  # Seconds between rate limiter snapshots written by an idle worker
+JOB_RETENTION_DAYS = 7  # Finished jobs older than this are deleted
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Job kinds run by the workers, mapped to handler functions further down
+HANDLERS = {}
+
+
+def _connect(db_path=None):
+    conn = sqlite3.connect(db_path or JOB_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def init_db(db_path=None):
+    conn = _connect(db_path)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                dedup_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress REAL NOT NULL DEFAULT 0,
+                message TEXT,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                worker_pid INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # Databases created before heartbeats were added lack these columns
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "worker_pid" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN worker_pid INTEGER")
+        if "attempts" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        # Latest OpenAI rate limiter snapshot of each worker process, for the UI
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS limiter_metrics (
+                pid INTEGER PRIMARY KEY,
+                metrics TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs (dedup_key, status)")
+    finally:
+        conn.close()
+
+
+def _dedup_key(kind, payload):
+    canonical = json.dumps({"kind": kind, "payload": payload}, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def encode_file(uploaded_file):
+    # Uploaded files can't cross process boundaries, so ship the raw bytes instead
+    return {"name": uploaded_file.name, "data": base64.b64encode(uploaded_file.getvalue()).decode("ascii")}
+
+
+class _JobFile(io.BytesIO):
+    # Mimics the parts of Streamlit's UploadedFile that extract_text_from_file uses
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def decode_file(encoded):
+    return _JobFile(encoded["name"], base64.b64decode(encoded["data"]))
+
+
+def _source_id(encoded):
+    return hashlib.sha256(f"{encoded['name']}\0{encoded['data']}".encode("utf-8")).hexdigest()[:32]
+
+
+def ingest_payload(uploaded_file):
+    # The source_id is fixed at submission so a retried job upserts over the same
+    # vectors; it's derived from the file so resubmitting an upload is still deduped
+    encoded = encode_file(uploaded_file)
+    return {"file": encoded, "source_id": _source_id(encoded)}
+
+
+def submit_job(kind, payload, dedupe_running=True, db_path=None):
+    """Queue a job and return its ID.
+
+    If an identical job (same kind and payload) is still queued or running,
+    its ID is returned instead of queueing a duplicate. Running jobs whose
+    worker has stopped sending heartbeats don't count. With
+    dedupe_running=False only queued jobs count, for jobs that must see
+    changes made after an identical running job started.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+
+    dedup_key = _dedup_key(kind, payload)
+    conn = _connect(db_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if dedupe_running:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE dedup_key = ? AND (status = ? OR (status = ? AND updated_at >= ?)) "
+                "ORDER BY created_at LIMIT 1",
+                (dedup_key, STATUS_QUEUED, STATUS_RUNNING, time.time() - STALE_JOB_TIMEOUT)
+            ).fetchone()
+        else:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE dedup_key = ? AND status = ? ORDER BY created_at LIMIT 1",
+                (dedup_key, STATUS_QUEUED)
+            ).fetchone()
+        if row:
+            conn.execute("COMMIT")
+            logger.info(f"Job {kind} already pending with ID: {row['id']}")
+            return row["id"]
+
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        conn.execute(
+            "INSERT INTO jobs (id, kind, payload, dedup_key, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), dedup_key, STATUS_QUEUED, now, now)
+        )
+        conn.execute("COMMIT")
+        logger.info(f"Queued job {kind} with ID: {job_id}")
+        return job_id
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _row_to_job(row):
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "progress": row["progress"],
+        "message": row["message"],
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+def get_job(job_id, db_path=None):
+    conn = _connect(db_path)
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+    finally:
+        conn.close()
+
+
+def get_jobs(job_ids, db_path=None):
+    if not job_ids:
+        return []
+    conn = _connect(db_path)
+    try:
+        placeholders = ", ".join("?" for _ in job_ids)
+        rows = conn.execute(
+            f"SELECT * FROM jobs WHERE id IN ({placeholders}) ORDER BY created_at", list(job_ids)
+        ).fetchall()
+        return [_row_to_job(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def update_progress(job_id, progress, message=None, db_path=None):
+    conn = _connect(db_path)
+    try:
+        conn.execute(
+            "UPDATE jobs SET progress = ?, message = COALESCE(?, message), updated_at = ? WHERE id = ?",
+            (min(max(float(progress), 0.0), 1.0), message, time.time(), job_id)
+        )
+    finally:
+        conn.close()
+
+
+def _reclaim_stale_jobs(conn):
+    # Running jobs whose worker stopped sending heartbeats (killed, OOM, server restart)
+    now = time.time()
+    cutoff = now - STALE_JOB_TIMEOUT
+    failed = conn.execute(
+        "UPDATE jobs SET status = ?, error = ?, payload = 'null', updated_at = ? "
+        "WHERE status = ? AND updated_at < ? AND attempts >= ?",
+        (STATUS_FAILED, "Worker stopped responding while running this job", now, STATUS_RUNNING, cutoff, MAX_ATTEMPTS)
+    ).rowcount
+    requeued = conn.execute(
+        "UPDATE jobs SET status = ?, progress = 0, worker_pid = NULL, updated_at = ? WHERE status = ? AND updated_at < ?",
+        (STATUS_QUEUED, now, STATUS_RUNNING, cutoff)
+    ).rowcount
+    if failed or requeued:
+        logger.warning(f"Reclaimed stale jobs: {requeued} requeued, {failed} failed")
+
+
+def _claim_next_job(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _reclaim_stale_jobs(conn)
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (STATUS_QUEUED,)
+        ).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker_pid = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (STATUS_RUNNING, os.getpid(), time.time(), row["id"])
+            )
+        conn.execute("COMMIT")
+        return row
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _finish_job(conn, job_id, status, result=None, error=None):
+    # The payload can hold a whole uploaded file, so it is dropped once the job is finished.
+    # Only the worker still holding the job may finish it: one wrongly judged dead
+    # must not overwrite the outcome of the attempt that replaced it.
+    cursor = conn.execute(
+        "UPDATE jobs SET status = ?, progress = CASE WHEN ? = ? THEN 1 ELSE progress END, "
+        "result = ?, error = ?, payload = 'null', updated_at = ? WHERE id = ? AND status = ? AND worker_pid = ?",
+        (status, status, STATUS_DONE, json.dumps(result) if result is not None else None, error, time.time(), job_id,
+         STATUS_RUNNING, os.getpid())
+    )
+    if not cursor.rowcount:
+        logger.warning(f"Job {job_id} was reclaimed by another worker; discarding this worker's {status} result")
+    return cursor.rowcount > 0
+
+
+def _heartbeat(conn, job_id):
+    conn.execute(
+        "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = ? AND worker_pid = ?",
+        (time.time(), job_id, STATUS_RUNNING, os.getpid())
+    )
+
+
+def prune_finished_jobs(max_age_days=JOB_RETENTION_DAYS, db_path=None):
+    conn = _connect(db_path)
+    try:
+        cursor = conn.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (STATUS_DONE, STATUS_FAILED, time.time() - max_age_days * 86400)
+        )
+        if cursor.rowcount:
+            logger.info(f"Pruned {cursor.rowcount} finished job(s)")
+    finally:
+        conn.close()
+
+
+def _record_limiter_metrics(conn):
+    now = time.time()
+    conn.execute(
+        "INSERT OR REPLACE INTO limiter_metrics (pid, metrics, updated_at) VALUES (?, ?, ?)",
+        (os.getpid(), json.dumps(get_rate_limiter().metrics()), now)
+    )
+    # Snapshots of workers that have exited
+    conn.execute("DELETE FROM limiter_metrics WHERE updated_at < ?", (now - STALE_JOB_TIMEOUT,))
+
+
+def get_limiter_metrics(db_path=None):
+    """Return [(pid, metrics)] for the live worker processes, from their latest snapshots."""
+    conn = _connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT pid, metrics FROM limiter_metrics WHERE updated_at >= ? ORDER BY pid",
+            (time.time() - STALE_JOB_TIMEOUT,)
+        ).fetchall()
+        return [(row["pid"], json.loads(row["metrics"])) for row in rows]
+    except sqlite3.OperationalError:
+        # The first page render can come before the worker pool has created the table
+        return []
+    finally:
+        conn.close()
+
+
+class JobProgress:
+    # Stand-in for st.progress so generate_report can report progress from a worker
+    def __init__(self, job_id, db_path=None):
+        self.job_id = job_id
+        self.db_path = db_path
+
+    def progress(self, value, text=None):
+        update_progress(self.job_id, value, text, db_path=self.db_path)
+
+
+class _WorkerContext:
+    # Per-process backend connections, created lazily on the first job that needs them
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._pinecone_connection = None
+
+    @property
+    def pinecone_connection(self):
+        if self._pinecone_connection is None:
+            from pinecone_integration import initialize_pinecone, PineconeConnection
+            index = initialize_pinecone()
+            if index is None:
+                raise ConnectionError("Failed to initialize database connection")
+            self._pinecone_connection = PineconeConnection(index)
+        return self._pinecone_connection
+
+
+def _handle_ingest_document(ctx, job_id, payload):
+    from file_processing import extract_chunks_from_file
+    from utils import get_embedding
+
+    uploaded_file = decode_file(payload["file"])
+    update_progress(job_id, 0.05, f"Extracting text from {uploaded_file.name}", db_path=ctx.db_path)
+    chunks = extract_chunks_from_file(uploaded_file)
+    if not chunks:
+        raise ValueError(f"No content found in {uploaded_file.name}")
+
+    # Tables are stored one row block per document so retrieval can pinpoint rows;
+    # the shared source_id groups them back into one Knowledge Base entry.
+    # Chunk ids are deterministic so a retry after a worker died overwrites its partial upload.
+    source_id = payload.get("source_id") or _source_id(payload["file"])
+    added = []
+    try:
+        for i, chunk in enumerate(chunks):
+            title = f"{uploaded_file.name} ({chunk['label']})" if chunk["label"] else uploaded_file.name
+            embedding = get_embedding(chunk["text"])
+            doc_id = ctx.pinecone_connection.add_document(title, chunk["text"], embedding, source_id=source_id,
+                                                          source=uploaded_file.name, document_id=f"{source_id}-{i}")
+            if not doc_id:
+                raise RuntimeError(f"Failed to add {title} to the Knowledge Base")
+            added.append((doc_id, embedding))
+            update_progress(job_id, 0.1 + 0.9 * (i + 1) / len(chunks), f"Saved {i + 1} of {len(chunks)} chunk(s)",
+                            db_path=ctx.db_path)
+    finally:
+        # Evidence is invalidated once for the whole file (or the part of it that was saved)
+        evidence_index.documents_added(added)
+
+    request_evidence_refresh(db_path=ctx.db_path)
+    return {"document_ids": [doc_id for doc_id, _ in added], "title": uploaded_file.name}
+
+
+def request_evidence_refresh(db_path=None):
+    # A precompute already running may have passed the questions just invalidated,
+    # so only an identical queued job counts as a duplicate
+    return submit_job("precompute_evidence", {}, dedupe_running=False, db_path=db_path)
+
+
+def _handle_generate_report(ctx, job_id, payload):
+    from utils import generate_report
+
+    questionnaire_id = payload.get("questionnaire_id")
+    saved = ctx.pinecone_connection.get_questionnaire(questionnaire_id) if questionnaire_id else None
+    if saved is not None and evidence_index.matches_questions(saved["questions"], payload["questions"]):
+        # Unchanged saved questionnaire: use precomputed drafts, refreshing only stale questions
+        update_progress(job_id, 0.0, "Loading precomputed evidence", db_path=ctx.db_path)
+        report = evidence_index.refresh_questionnaire(ctx.pinecone_connection, payload["questionnaire_id"],
+                                                      payload["questions"], JobProgress(job_id, ctx.db_path))
+    else:
+        update_progress(job_id, 0.0, "Loading documents", db_path=ctx.db_path)
+        documents = ctx.pinecone_connection.get_all_documents()
+        logger.info(f"Retrieved {len(documents)} documents for report generation")
+        report = generate_report(payload["questions"], documents, JobProgress(job_id, ctx.db_path))
+    logger.info(f"Report generated successfully with {len(report)} items")
+
+    report_id = ctx.pinecone_connection.add_report(payload["title"], report)
+    if not report_id:
+        raise RuntimeError("Failed to save the generated report")
+    return {"report_id": report_id, "title": payload["title"]}
+
+
+def _handle_precompute_evidence(ctx, job_id, payload):
+    questionnaires = ctx.pinecone_connection.get_all_questionnaires()
+    for i, questionnaire in enumerate(questionnaires):
+        update_progress(job_id, i / len(questionnaires), f"Refreshing evidence for {questionnaire['title']}",
+                        db_path=ctx.db_path)
+        # Questions a report job is already refreshing are left to it
+        evidence_index.refresh_questionnaire(ctx.pinecone_connection, questionnaire["id"], questionnaire["questions"],
+                                             wait_for_others=False, prune=True)
+    return {"questionnaires": len(questionnaires), "title": "Evidence index"}
+
+
+HANDLERS["ingest_document"] = _handle_ingest_document
+HANDLERS["generate_report"] = _handle_generate_report
+HANDLERS["precompute_evidence"] = _handle_precompute_evidence
+
+
+def _run_job(ctx, conn, row):
+    job_id = row["id"]
+    kind = row["kind"]
+    logger.info(f"Worker {os.getpid()} running job {kind} ({job_id})")
+
+    # Handlers can block for a long time on API calls, so liveness is reported from a side thread
+    finished = threading.Event()
+
+    def send_heartbeats():
+        heartbeat_conn = _connect(ctx.db_path)
+        try:
+            while not finished.wait(HEARTBEAT_INTERVAL):
+                _heartbeat(heartbeat_conn, job_id)
+        finally:
+            heartbeat_conn.close()
+
+    heartbeat_thread = threading.Thread(target=send_heartbeats, name=f"heartbeat-{job_id}", daemon=True)
+    heartbeat_thread.start()
+    try:
+        result = HANDLERS[kind](ctx, job_id, json.loads(row["payload"]))
+        _finish_job(conn, job_id, STATUS_DONE, result=result)
+        logger.info(f"Job {kind} ({job_id}) finished")
+    except Exception as e:
+        logger.exception(f"Job {kind} ({job_id}) failed: {str(e)}")
+        _finish_job(conn, job_id, STATUS_FAILED, error=str(e))
+    finally:
+        finished.set()
+        heartbeat_thread.join()
+
+
+def worker_loop(db_path=None, quota_share=1.0, stop_event=None):
+    logging.basicConfig(level=logging.INFO)
+    set_quota_share(quota_share)
+
+    ctx = _WorkerContext(db_path)
+    conn = _connect(db_path)
+    last_metrics = 0
+    try:
+        while stop_event is None or not stop_event.is_set():
+            if time.time() - last_metrics >= METRICS_INTERVAL:
+                _record_limiter_metrics(conn)
+                last_metrics = time.time()
+            row = _claim_next_job(conn)
+            if row is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            _run_job(ctx, conn, row)
+            _record_limiter_metrics(conn)
+            last_metrics = time.time()
+    finally:
+        conn.close()
+
+
+class WorkerPool:
+    """Background worker processes plus a thread that restarts any that die.
+
+    Create one per server process (main.py wraps get_job_workers in
+    st.cache_resource). Jobs orphaned by a dead worker are picked up again by
+    the heartbeat timeout in _claim_next_job, not by the pool.
+    """
+
+    def __init__(self, num_workers=None, db_path=None):
+        if num_workers is None:
+            num_workers = int(get_secret("JOB_WORKERS", 2))
+        self.num_workers = num_workers
+        self.db_path = db_path
+        # The Streamlit process keeps a small slice of the OpenAI quota; workers split the rest
+        interactive_share, self.quota_share = worker_quota_shares(num_workers)
+        # Spawn rather than fork so workers don't inherit Streamlit's threads
+        self._mp_context = multiprocessing.get_context("spawn")
+        self.processes = []
+        self._last_prune = 0
+
+        init_db(db_path)
+        evidence_index.init_db()
+        set_quota_share(interactive_share)
+        for _ in range(num_workers):
+            self.processes.append(self._start_process())
+        logger.info(f"Started {len(self.processes)} job worker(s)")
+
+        self._supervisor = threading.Thread(target=self._supervise, name="job-worker-supervisor", daemon=True)
+        self._supervisor.start()
+
+    def _start_process(self):
+        process = self._mp_context.Process(target=worker_loop, args=(self.db_path, self.quota_share), daemon=True)
+        process.start()
+        return process
+
+    def _supervise(self):
+        while True:
+            time.sleep(SUPERVISOR_INTERVAL)
+            for i, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning(f"Job worker {process.pid} exited with code {process.exitcode}; restarting")
+                    self.processes[i] = self._start_process()
+            if time.time() - self._last_prune > 3600:
+                try:
+                    prune_finished_jobs(db_path=self.db_path)
+                except Exception as e:
+                    logger.error(f"Failed to prune finished jobs: {str(e)}")
+                self._last_prune = time.time()
+
+
+def start_workers(num_workers=None, db_path=None):
+    return WorkerPool(num_workers, db_path)
@@ -1,30 +1,99 @@
-import os
-import io
-import uuid
-import json
-import re
-import docx
-import PyPDF2
-import pandas as pd
 import streamlit as st
 import logging
-import asyncio
-import openai
-from functools import partial
-from tenacity import retry, wait_random_exponential, stop_after_attempt
 
-from pinecone_integration import initialize_pinecone, PineconeConnection
+from pinecone_integration import PineconeLoader
 from file_processing import extract_text_from_file
-from utils import get_secret, get_embedding, chat_completion, display_questionnaire, generate_report
+from utils import get_secret, get_embedding, chat_completion, display_questionnaire
+from job_queue import start_workers, submit_job, request_evidence_refresh, get_jobs, get_limiter_metrics, ingest_payload, STATUS_DONE, STATUS_FAILED
+import evidence_index
+from rate_limiter import get_rate_limiter, combine_metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 PINECONE_DIMENSION = 1536  # Set this to match your index dimension
+JOB_POLL_INTERVAL = 2  # Seconds between refreshes of the background jobs panel
+CONNECTION_POLL_INTERVAL = 1  # Seconds between checks on the background database connection
 
 def set_page_config():
     st.set_page_config(page_title="DUE: Document Understanding Engine", layout="wide")
 
+@st.cache_resource
+def get_pinecone_loader():
+    # Started once per server; sessions render in degraded mode until it is ready
+    return PineconeLoader()
+
+@st.cache_resource
+def get_job_workers():
+    # One pool of worker processes per server, shared by every session
+    return start_workers()
+
+def track_job(job_id):
+    job_ids = st.session_state.setdefault("job_ids", [])
+    if job_id not in job_ids:
+        job_ids.append(job_id)
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def display_jobs_panel():
+    # Reruns on its own every JOB_POLL_INTERVAL seconds; call it inside `with st.sidebar`
+    job_ids = st.session_state.get("job_ids", [])
+    if not job_ids:
+        return
+    st.header("Background Jobs")
+    jobs = get_jobs(job_ids)
+    for job in jobs:
+        label = job['result']['title'] if job['result'] and 'title' in job['result'] else job['kind'].replace('_', ' ')
+        if job['status'] == STATUS_DONE:
+            st.success(f"Finished: {label}")
+        elif job['status'] == STATUS_FAILED:
+            st.error(f"Failed: {job['kind'].replace('_', ' ')} ({job['error']})")
+        else:
+            st.progress(job['progress'], text=f"{job['status'].capitalize()}: {job['message'] or label}")
+
+    # A job that just finished changed the Knowledge Base or reports, so redraw the whole page
+    finished = {job['id'] for job in jobs if job['status'] in (STATUS_DONE, STATUS_FAILED)}
+    seen_finished = st.session_state.setdefault("finished_job_ids", set())
+    newly_finished = finished - seen_finished
+    seen_finished.update(finished)
+    if newly_finished:
+        st.rerun()
+
+    if st.button("Clear Finished"):
+        st.session_state["job_ids"] = [job_id for job_id in job_ids if job_id not in finished]
+        st.rerun()
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def display_rate_limiter_metrics():
+    # This server process's limiter plus the snapshots the job workers (which make most calls) write to jobs.db.
+    # Call it inside `with st.sidebar`
+    snapshots = [("This server", get_rate_limiter().metrics())]
+    snapshots += [(f"Worker {pid}", metrics) for pid, metrics in get_limiter_metrics()]
+    with st.expander("OpenAI Rate Limiter"):
+        paused = [label for label, metrics in snapshots if metrics['circuit_state'] != "closed"]
+        if paused:
+            st.warning(f"Circuit breaker is open for {', '.join(paused)}; OpenAI requests from it are paused.")
+        process = st.selectbox("Process", ["All processes"] + [label for label, _ in snapshots], key="rate_limiter_process")
+        if process == "All processes":
+            metrics = combine_metrics([metrics for _, metrics in snapshots])
+        else:
+            metrics = dict(snapshots)[process]
+        for name, value in metrics.items():
+            st.write(f"{name.replace('_', ' ').capitalize()}: {round(value, 1) if isinstance(value, float) else value}")
+
+@st.fragment(run_every=CONNECTION_POLL_INTERVAL)
+def display_connection_status(pinecone_loader, rendered_status):
+    # Polls the background Pinecone init; the page was laid out for rendered_status,
+    # so once the loader moves on the whole page is redrawn
+    if pinecone_loader.status != rendered_status:
+        st.rerun()
+    if rendered_status == PineconeLoader.CONNECTING:
+        st.info("Connecting to the database... Knowledge Base, saved questionnaires and reports will be available shortly.")
+    elif rendered_status == PineconeLoader.FAILED:
+        st.error("Failed to initialize database connection. Some features will be unavailable.")
+        if st.button("Retry Connection"):
+            pinecone_loader.start()
+            st.rerun()
+
 def display_reports_tab(pinecone_connection):
     st.header("Generated Reports")
     reports = pinecone_connection.get_all_reports()
@@ -34,6 +103,8 @@ def display_reports_tab(pinecone_connection):
                 for i, qa in enumerate(report['report'], 1):
                     with st.expander(f"Q{i}: {qa['question']}"):
                         st.write("Answer:", qa['answer'])
+                        if qa.get('evidence'):
+                            st.caption("Evidence: " + "; ".join(doc['title'] for doc in qa['evidence']))
                         if qa['needs_assignment']:
                             if st.button(f"Assign for Manual Answer", key=f"assign_{report['id']}_{i}"):
                                 st.info("This feature will be implemented in the future.")
@@ -132,18 +203,15 @@ def main():
 
     st.title("DUE: Document Understanding Engine")
 
-    # Set up OpenAI API
-    openai.api_key = get_secret("OPENAI_API_KEY")
-    if not openai.api_key:
+    # The OpenAI client itself is imported lazily on first use (see utils)
+    if not get_secret("OPENAI_API_KEY"):
         st.error("OpenAI API key is not set. Some features may not work.")
 
-    # Initialize Pinecone
-    pinecone_index = initialize_pinecone()
-    if pinecone_index is None:
-        st.error("Failed to initialize database connection. Some features will be unavailable.")
-        return
-
-    pinecone_connection = PineconeConnection(pinecone_index)
+    # Pinecone is initialized in the background; until then the database-backed features are disabled
+    pinecone_loader = get_pinecone_loader()
+    pinecone_connection = pinecone_loader.connection
+    if pinecone_loader.status != PineconeLoader.READY:
+        display_connection_status(pinecone_loader, pinecone_loader.status)
 
     # Sidebar: Knowledge Base Upload
     st.sidebar.header("Add Content to Knowledge Base")
@@ -151,18 +219,14 @@ def main():
                                         type=["txt", "pdf", "docx", "xlsx", "xls"], 
                                         accept_multiple_files=True)
     if kb_files and st.sidebar.button("Process Knowledge Base File(s)"):
-        if pinecone_connection.test_connection():
+        if pinecone_connection is not None and pinecone_connection.test_connection():
             for uploaded_file in kb_files:
                 try:
-                    file_contents = extract_text_from_file(uploaded_file)
-                    embedding = get_embedding(file_contents)
-                    doc_id = pinecone_connection.add_document(uploaded_file.name, file_contents, embedding)
-                    if doc_id:
-                        st.sidebar.success(f"Processed {uploaded_file.name}")
-                    else:
-                        st.sidebar.error(f"Failed to process {uploaded_file.name}")
+                    job_id = submit_job("ingest_document", ingest_payload(uploaded_file))
+                    track_job(job_id)
+                    st.sidebar.info(f"Queued {uploaded_file.name} for processing")
                 except Exception as e:
-                    st.sidebar.error(f"Error processing {uploaded_file.name}: {str(e)}")
+                    st.sidebar.error(f"Error queueing {uploaded_file.name}: {str(e)}")
         else:
             st.sidebar.error("Cannot process files: No database connection")
 
@@ -181,24 +245,38 @@ def main():
                 st.sidebar.error(f"An error occurred while processing the questionnaire: {str(e)}")
                 logger.exception("Error in questionnaire processing")
 
+    with st.sidebar:
+        display_jobs_panel()
+        display_rate_limiter_metrics()
+
     # Main area tabs
     kb_tab, questionnaire_tab, reports_tab, query_tab = st.tabs(["Knowledge Base", "Questionnaires", "Generated Reports", "Ask a Question"])
 
     # Knowledge Base tab
     with kb_tab:
         st.header("Knowledge Base Documents")
-        if pinecone_connection.test_connection():
+        if pinecone_connection is not None and pinecone_connection.test_connection():
             documents = pinecone_connection.get_all_documents()
             if documents:
+                # Files stored as several chunks (e.g. spreadsheet row blocks) are listed and deleted as one
+                sources = {}
                 for doc in documents:
-                    with st.expander(f"{doc['title']}"):
-                        st.write(doc['text'][:300] + "..." if len(doc['text']) > 300 else doc['text'])
-                        if st.button("Delete", key=f"delete_doc_{doc['id']}"):
-                            if pinecone_connection.delete_document(doc['id']):
-                                st.success(f"Document '{doc['title']}' deleted successfully.")
-                                st.experimental_rerun()
+                    sources.setdefault(doc['source_id'], []).append(doc)
+                for source_id, source_docs in sources.items():
+                    source = source_docs[0]['source']
+                    label = f"{source} ({len(source_docs)} chunks)" if len(source_docs) > 1 else source
+                    with st.expander(label):
+                        text = source_docs[0]['text']
+                        st.write(text[:300] + "..." if len(text) > 300 else text)
+                        if st.button("Delete", key=f"delete_doc_{source_id}"):
+                            doc_ids = [doc['id'] for doc in source_docs]
+                            if pinecone_connection.delete_documents(doc_ids):
+                                if evidence_index.documents_deleted(doc_ids):
+                                    track_job(request_evidence_refresh())
+                                st.success(f"Document '{source}' deleted successfully.")
+                                st.rerun()
                             else:
-                                st.error(f"Failed to delete document '{doc['title']}'.")
+                                st.error(f"Failed to delete document '{source}'.")
             else:
                 st.info("No documents available in the Knowledge Base.")
         else:
@@ -219,7 +297,7 @@ def main():
                 
                 col1, col2 = st.columns(2)
                 with col1:
-                    if st.button("Save Questionnaire"):
+                    if st.button("Save Questionnaire", disabled=pinecone_connection is None):
                         try:
                             questionnaire_id = pinecone_connection.add_questionnaire(
                                 st.session_state["current_questionnaire"]["title"], 
@@ -228,6 +306,9 @@ def main():
                             if questionnaire_id:
                                 st.success(f"Questionnaire saved successfully. ID: {questionnaire_id}")
                                 st.session_state["current_questionnaire"]["questions"] = edited_questions
+                                st.session_state["current_questionnaire"]["id"] = questionnaire_id
+                                # Precompute evidence and draft answers so its reports are quick to generate
+                                track_job(request_evidence_refresh())
                             else:
                                 st.error("Failed to save questionnaire.")
                         except Exception as e:
@@ -238,26 +319,18 @@ def main():
                 with col2:
                     if st.button("Generate Report"):
                         try:
-                            with st.spinner("Generating report..."):
-                                documents = pinecone_connection.get_all_documents()
-                                logger.info(f"Retrieved {len(documents)} documents for report generation")
-                                progress_bar = st.progress(0)
-                                report = generate_report(edited_questions, documents, progress_bar)
-                                logger.info(f"Report generated successfully with {len(report)} items")
-                            
-                            logger.info(f"Attempting to save report...")
                             report_title = f"Report for {st.session_state['current_questionnaire']['title']}"
                             logger.info(f"Report title: {report_title}")
-                            report_id = pinecone_connection.add_report(report_title, report)
-                            if report_id:
-                                logger.info(f"Report saved successfully with ID: {report_id}")
-                                st.success(f"Report generated and saved successfully. View it in the 'Generated Reports' tab.")
-                            else:
-                                logger.error("Failed to save the generated report. Returned report_id is None or empty.")
-                                st.error("Failed to save the generated report.")
+                            payload = {"title": report_title, "questions": edited_questions}
+                            if st.session_state["current_questionnaire"].get("id"):
+                                # Saved questionnaires are answered from the precomputed evidence index
+                                payload["questionnaire_id"] = st.session_state["current_questionnaire"]["id"]
+                            job_id = submit_job("generate_report", payload)
+                            track_job(job_id)
+                            st.success("Report generation started. Track its progress in the sidebar; the report will appear in the 'Generated Reports' tab when done.")
                         except Exception as e:
-                            logger.exception(f"Error generating or saving report: {str(e)}")
-                            st.error(f"Error generating or saving report: {str(e)}")
+                            logger.exception(f"Error queueing report generation: {str(e)}")
+                            st.error(f"Error queueing report generation: {str(e)}")
             else:
                 st.warning("The current questionnaire has no questions.")
         else:
@@ -266,8 +339,10 @@ def main():
         # Display saved questionnaires
         st.header("Saved Questionnaires")
         try:
-            saved_questionnaires = pinecone_connection.get_all_questionnaires()
-            if saved_questionnaires:
+            saved_questionnaires = pinecone_connection.get_all_questionnaires() if pinecone_connection is not None else None
+            if saved_questionnaires is None:
+                st.info("Database connection required to view saved questionnaires.")
+            elif saved_questionnaires:
                 for q in saved_questionnaires:
                     with st.expander(f"Questionnaire: {q['title']}"):
                         st.write(f"ID: {q['id']}")
@@ -282,6 +357,7 @@ def main():
                         with col2:
                             if st.button("Delete", key=f"delete_{q['id']}"):
                                 if pinecone_connection.delete_questionnaire(q['id']):
+                                    evidence_index.forget_questionnaire(q['id'])
                                     st.success(f"Questionnaire '{q['title']}' deleted successfully.")
                                     st.experimental_rerun()
                                 else:
@@ -302,14 +378,17 @@ def main():
         
     # Reports tab
     with reports_tab:
-        display_reports_tab(pinecone_connection)
+        if pinecone_connection is not None:
+            display_reports_tab(pinecone_connection)
+        else:
+            st.info("Database connection required to view generated reports.")
 
     # Ask a Question tab
     with query_tab:
         st.header("Ask a Question")
         query = st.text_input("Enter your question about the documents in the Knowledge Base")
         if st.button("Submit"):
-            if pinecone_connection.test_connection():
+            if pinecone_connection is not None and pinecone_connection.test_connection():
                 try:
                     query_embedding = get_embedding(query)
                     similar_docs = pinecone_connection.get_similar_documents(query_embedding)
@@ -346,5 +425,9 @@ def main():
             else:
                 st.error("Cannot perform query: No database connection")
 
+    # Long-running work (ingestion, report generation) happens in worker processes.
+    # Started after the page is laid out so spawning them doesn't delay first paint.
+    get_job_workers()
+
 if __name__ == "__main__":
     main()
@@ -1,13 +1,17 @@
-import pinecone
-from pinecone import Pinecone, PodSpec
 import logging
+import threading
 import uuid
 import json
-from utils import get_secret
+import streamlit as st
+from utils import get_secret, get_embedding
 
 logger = logging.getLogger(__name__)
 
+DELETE_BATCH_SIZE = 1000  # Pinecone rejects deletes of more ids than this in one call
+
 def initialize_pinecone():
+    from pinecone import Pinecone, PodSpec
+
     pinecone_api_key = get_secret("PINECONE_API_KEY")
     pinecone_environment = get_secret("PINECONE_ENVIRONMENT")
     index_name = get_secret("PINECONE_INDEX_NAME")
@@ -44,6 +48,40 @@ def initialize_pinecone():
         logger.error(f"Failed to initialize Pinecone: {str(e)}")
         return None
 
+class PineconeLoader:
+    """Runs initialize_pinecone in a background thread.
+
+    The index check (and possible create) can take seconds, so the UI renders
+    in a degraded mode while status is "connecting" instead of waiting on it.
+    """
+    CONNECTING = "connecting"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self):
+        self.status = self.CONNECTING
+        self.connection = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self.status = self.CONNECTING
+            self._thread = threading.Thread(target=self._load, name="pinecone-init", daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        index = initialize_pinecone()
+        if index is None:
+            self.status = self.FAILED
+            return
+        self.connection = PineconeConnection(index)
+        self.status = self.READY
+        logger.info("Pinecone connection ready")
+
 class PineconeConnection:
     def __init__(self, index):
         self.index = index
@@ -56,10 +94,16 @@ class PineconeConnection:
             st.error(f"Connection test failed: {str(e)}")
             return False
 
-    def add_document(self, title, text, embedding):
+    def add_document(self, title, text, embedding, source_id=None, source=None, document_id=None):
+        # source_id/source group the chunks of one uploaded file so they can be listed and deleted together;
+        # passing a document_id makes re-adding the same chunk overwrite it instead of duplicating it
         try:
-            id = str(uuid.uuid4())
-            self.index.upsert(vectors=[(id, embedding, {"title": title, "text": text, "type": "document"})])
+            id = document_id or str(uuid.uuid4())
+            metadata = {"title": title, "text": text, "type": "document"}
+            if source_id:
+                metadata["source_id"] = source_id
+                metadata["source"] = source or title
+            self.index.upsert(vectors=[(id, embedding, metadata)])
             return id
         except Exception as e:
             st.error(f"Error adding document: {str(e)}")
@@ -68,15 +112,22 @@ class PineconeConnection:
     def get_all_documents(self):
         try:
             results = self.index.query(vector=[0]*1536, filter={"type": "document"}, top_k=10000, include_metadata=True)
-            return [{"id": match['id'], "title": match['metadata']['title'], "text": match['metadata']['text']} 
+            return [{"id": match['id'], "title": match['metadata']['title'], "text": match['metadata']['text'],
+                     "source_id": match['metadata'].get('source_id', match['id']),
+                     "source": match['metadata'].get('source', match['metadata']['title'])}
                     for match in results['matches']]
         except Exception as e:
             st.error(f"Error getting documents: {str(e)}")
             return []
 
     def delete_document(self, document_id):
+        return self.delete_documents([document_id])
+
+    def delete_documents(self, document_ids):
         try:
-            self.index.delete(ids=[document_id])
+            document_ids = list(document_ids)
+            for start in range(0, len(document_ids), DELETE_BATCH_SIZE):
+                self.index.delete(ids=document_ids[start:start + DELETE_BATCH_SIZE])
             return True
         except Exception as e:
             st.error(f"Error deleting document: {str(e)}")
@@ -0,0 +1,350 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Rough characters-per-token ratio used to estimate request size before sending
+CHARS_PER_TOKEN = 4
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def is_rate_limit_error(e):
+    return (type(e).__name__ == "RateLimitError"
+            or getattr(e, "http_status", None) == 429
+            or getattr(e, "status_code", None) == 429)
+
+
+def is_server_error(e):
+    status = getattr(e, "http_status", None) or getattr(e, "status_code", None)
+    if status is not None:
+        return status >= 500
+    return type(e).__name__ in ("APIError", "ServiceUnavailableError", "Timeout", "APITimeoutError",
+                                "APIConnectionError", "InternalServerError")
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_per_second)
+        self.last_refill = now
+
+    def try_acquire(self, amount):
+        # Returns 0 if the tokens were taken, otherwise the seconds to wait before retrying
+        amount = min(float(amount), self.capacity)
+        with self.lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.refill_per_second
+
+    def adjust(self, amount):
+        # Positive amounts refund tokens, negative amounts charge extra (can go into debt)
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def available(self):
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError("OpenAI circuit breaker is open; requests are paused after repeated failures")
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.HALF_OPEN:
+                # Only one trial request at a time while deciding whether to close again
+                if self.trial_in_flight:
+                    raise CircuitOpenError("OpenAI circuit breaker is half-open; waiting on trial request")
+                self.trial_in_flight = True
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("OpenAI circuit breaker closed")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    logger.warning(f"OpenAI circuit breaker opened after {self.consecutive_failures} consecutive failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def seconds_until_trial(self):
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_neutral(self):
+        # The request failed for a reason unrelated to service health (bad input etc.)
+        with self.lock:
+            self.trial_in_flight = False
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight requests: halves on 429s, grows by one per window of successes."""
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=16):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial_limit, max_limit))
+        self.in_flight = 0
+        self.successes_since_change = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.successes_since_change += 1
+            if self.successes_since_change >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.successes_since_change = 0
+                self.condition.notify_all()
+
+    def on_rate_limited(self):
+        with self.condition:
+            new_limit = max(self.min_limit, self.limit // 2)
+            if new_limit != self.limit:
+                logger.info(f"Reducing OpenAI concurrency limit from {self.limit} to {new_limit}")
+            self.limit = new_limit
+            self.successes_since_change = 0
+
+
+class OpenAIRateLimiter:
+    """Process-wide throttle for OpenAI calls.
+
+    Combines requests/min and tokens/min buckets, a circuit breaker and an
+    adaptive concurrency limit. Every caller in the process shares one instance
+    (see get_rate_limiter), so concurrent sessions queue here instead of all
+    hitting the API and collecting 429s.
+
+    429s are throttling, not an outage: they trigger a short shared cooldown and
+    cut the concurrency limit. Only server and connection errors trip the breaker.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency=16,
+                 failure_threshold=5, reset_timeout=30, rate_limit_cooldown=5):
+        self.request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.concurrency = AdaptiveConcurrencyLimiter(initial_limit=max(1, max_concurrency // 2),
+                                                      max_limit=max_concurrency)
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "successes": 0,
+            "rate_limited": 0,
+            "server_errors": 0,
+            "other_errors": 0,
+            "rejected_open_circuit": 0,
+            "tokens_used": 0,
+            "throttle_wait_seconds": 0.0,
+        }
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def _wait_for_capacity(self, estimated_tokens):
+        waited = 0.0
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+                waited += pause
+                continue
+            wait = self.request_bucket.try_acquire(1)
+            if wait == 0:
+                wait = self.token_bucket.try_acquire(estimated_tokens)
+                if wait == 0:
+                    break
+                # Give the request slot back while waiting on token budget
+                self.request_bucket.adjust(1)
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            self._count("throttle_wait_seconds", waited)
+
+    def _enter_circuit(self, wait_for_circuit):
+        while True:
+            try:
+                self.breaker.before_call()
+                return
+            except CircuitOpenError:
+                self._count("rejected_open_circuit")
+                if not wait_for_circuit:
+                    raise
+            # Wait for the breaker's next trial window (or for the in-flight trial to finish)
+            time.sleep(max(self.breaker.seconds_until_trial(), 0.5))
+
+    @contextmanager
+    def request(self, estimated_tokens, wait_for_circuit=False):
+        """Wrap a single API call.
+
+        Yields a callback the caller should invoke with the actual token usage
+        once known, so the token bucket can be corrected for the estimate.
+        With wait_for_circuit=True an open circuit blocks until the breaker
+        lets requests through again instead of raising CircuitOpenError.
+        """
+        self._enter_circuit(wait_for_circuit)
+
+        self.concurrency.acquire()
+        usage = {"tokens": estimated_tokens}
+        tokens_charged = False
+
+        def report_usage(actual_tokens):
+            if actual_tokens:
+                usage["tokens"] = actual_tokens
+
+        try:
+            self._wait_for_capacity(estimated_tokens)
+            tokens_charged = True
+            self._count("requests")
+            yield report_usage
+        except Exception as e:
+            # Failed requests aren't billed, so give the estimated tokens back
+            if tokens_charged:
+                self.token_bucket.adjust(estimated_tokens)
+            if is_rate_limit_error(e):
+                self._count("rate_limited")
+                self.concurrency.on_rate_limited()
+                self.breaker.record_neutral()
+                # Back everyone off briefly instead of letting them all retry into the same 429
+                self.paused_until = max(self.paused_until, time.monotonic() + self.rate_limit_cooldown)
+            elif is_server_error(e):
+                self._count("server_errors")
+                self.breaker.record_failure()
+            else:
+                self._count("other_errors")
+                self.breaker.record_neutral()
+            raise
+        else:
+            self._count("successes")
+            self._count("tokens_used", usage["tokens"])
+            self.token_bucket.adjust(estimated_tokens - usage["tokens"])
+            self.concurrency.on_success()
+            self.breaker.record_success()
+        finally:
+            self.concurrency.release()
+
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.counters)
+        metrics.update({
+            "circuit_state": self.breaker.state,
+            "circuit_times_opened": self.breaker.times_opened,
+            "concurrency_limit": self.concurrency.limit,
+            "in_flight": self.concurrency.in_flight,
+            "requests_available": round(self.request_bucket.available(), 1),
+            "tokens_available": round(self.token_bucket.available()),
+        })
+        return metrics
+
+
+def combine_metrics(snapshots):
+    """Add up metrics() snapshots from several processes; the circuit state shown is the worst one."""
+    severity = [CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN]
+    combined = {}
+    for metrics in snapshots:
+        for name, value in metrics.items():
+            if name == "circuit_state":
+                current = combined.get(name, CircuitBreaker.CLOSED)
+                combined[name] = max(current, value, key=severity.index)
+            else:
+                combined[name] = combined.get(name, 0) + value
+    return combined
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+_quota_share = 1.0
+
+# The Streamlit process only serves interactive queries ("Ask a Question");
+# the rest of the quota goes to the job workers, which do the bulk of the calls
+INTERACTIVE_QUOTA_SHARE = 0.1
+
+
+def worker_quota_shares(num_workers):
+    """Return (interactive_share, per_worker_share) of the account quota."""
+    if num_workers <= 0:
+        return 1.0, 0.0
+    return INTERACTIVE_QUOTA_SHARE, (1.0 - INTERACTIVE_QUOTA_SHARE) / num_workers
+
+
+def set_quota_share(share):
+    # Fraction of the account quota this process may use, for when several
+    # processes (e.g. job workers) call OpenAI with the same key
+    global _quota_share, _rate_limiter
+    with _rate_limiter_lock:
+        _quota_share = share
+        _rate_limiter = None
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                from utils import get_secret
+                _rate_limiter = OpenAIRateLimiter(
+                    requests_per_minute=max(1, int(get_secret("OPENAI_REQUESTS_PER_MINUTE", 3000)) * _quota_share),
+                    tokens_per_minute=max(1, int(get_secret("OPENAI_TOKENS_PER_MINUTE", 250000)) * _quota_share),
+                    max_concurrency=max(1, int(int(get_secret("OPENAI_MAX_CONCURRENCY", 16)) * _quota_share)),
+                )
+    return _rate_limiter
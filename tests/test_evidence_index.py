@@ -0,0 +1,177 @@
+import threading
+
+import pytest
+
+import evidence_index
+
+
+class FakePinecone:
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = 0
+
+    def get_similar_documents(self, query_embedding, top_k=3):
+        self.queries += 1
+        return self.docs[:top_k]
+
+
+DOCS = [("d1", "T1", "text1", 0.9), ("d2", "T2", "text2", 0.8), ("d3", "T3", "text3", 0.7)]
+QUESTIONS = [{"question": "Q1"}, {"question": "Q2"}]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "evidence.db")
+    evidence_index.init_db(path)
+    return path
+
+
+@pytest.fixture
+def answered(monkeypatch):
+    answered = []
+
+    def answer_question(question, context):
+        answered.append(question["question"])
+        return {"question": question["question"], "answer": f"from {context}", "needs_assignment": False}
+
+    monkeypatch.setattr(evidence_index, "get_embedding", lambda text: [1.0, 0.0])
+    monkeypatch.setattr(evidence_index, "answer_question", answer_question)
+    return answered
+
+
+def _stored_questions(db_path, questionnaire_id="qn"):
+    conn = evidence_index._connect(db_path)
+    try:
+        return sorted(row["question"] for row in conn.execute(
+            "SELECT question FROM question_evidence WHERE questionnaire_id = ?", (questionnaire_id,)
+        ))
+    finally:
+        conn.close()
+
+
+def test_refresh_answers_once_then_reuses_drafts(db_path, answered):
+    pinecone = FakePinecone(DOCS)
+    report = evidence_index.refresh_questionnaire(pinecone, "qn", QUESTIONS, db_path=db_path)
+    assert answered == ["Q1", "Q2"]
+    assert report[0]["evidence"][0] == {"id": "d1", "title": "T1", "score": 0.9}
+
+    again = evidence_index.refresh_questionnaire(pinecone, "qn", QUESTIONS, db_path=db_path)
+    assert answered == ["Q1", "Q2"]
+    assert again == report
+
+
+def test_only_pruning_refresh_removes_other_questions(db_path, answered):
+    pinecone = FakePinecone(DOCS)
+    evidence_index.refresh_questionnaire(pinecone, "qn", QUESTIONS, db_path=db_path)
+    evidence_index.refresh_questionnaire(pinecone, "qn", [{"question": "Q1 edited"}], db_path=db_path)
+    assert _stored_questions(db_path) == ["Q1", "Q1 edited", "Q2"]
+
+    evidence_index.refresh_questionnaire(pinecone, "qn", QUESTIONS, prune=True, db_path=db_path)
+    assert _stored_questions(db_path) == ["Q1", "Q2"]
+
+
+def test_matches_questions_compares_question_text():
+    assert evidence_index.matches_questions(QUESTIONS, [{"question": " Q1 ", "type": "text"}, {"question": "Q2"}])
+    assert not evidence_index.matches_questions(QUESTIONS, [{"question": "Q1 edited"}, {"question": "Q2"}])
+    assert not evidence_index.matches_questions(QUESTIONS, QUESTIONS[:1])
+
+
+def test_document_deleted_invalidates_only_citing_questions(db_path, answered):
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS[:1], db_path=db_path)
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS[2:]), "qn", QUESTIONS[1:], db_path=db_path)
+    answered.clear()
+
+    assert evidence_index.document_deleted("d1", db_path=db_path) == 1
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS, db_path=db_path)
+    assert answered == ["Q1"]
+
+
+def test_documents_deleted_invalidates_for_a_whole_file(db_path, answered):
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS[:1]), "qn", QUESTIONS[:1], db_path=db_path)
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS[2:]), "qn", QUESTIONS[1:], db_path=db_path)
+    assert evidence_index.documents_deleted(["d2", "d3", "d3"], db_path=db_path) == 1
+    assert evidence_index.documents_deleted(["d1", "d3"], db_path=db_path) == 2
+
+
+def test_document_added_invalidates_by_similarity(db_path, answered):
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS, db_path=db_path)
+    # Orthogonal to the question embedding: can't beat the current top-3 (min score 0.7)
+    assert evidence_index.document_added("far", [0.0, 1.0], db_path=db_path) == 0
+    assert evidence_index.document_added("near", [1.0, 0.0], db_path=db_path) == 2
+
+
+def test_questions_with_too_little_evidence_are_always_invalidated(db_path, answered):
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS[:1]), "qn", QUESTIONS[:1], db_path=db_path)
+    assert evidence_index.document_added("far", [0.0, 1.0], db_path=db_path) == 1
+
+
+def test_embedding_failure_returns_error_item_and_stays_stale(db_path, answered, monkeypatch):
+    def fail(text):
+        raise RuntimeError("circuit open")
+
+    monkeypatch.setattr(evidence_index, "get_embedding", fail)
+    report = evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS, db_path=db_path)
+    assert all(item["needs_assignment"] and "circuit open" in item["answer"] for item in report)
+    assert _stored_questions(db_path) == []
+
+
+def test_empty_retrieval_is_not_cached_as_fresh(db_path, answered):
+    evidence_index.refresh_questionnaire(FakePinecone([]), "qn", QUESTIONS[:1], db_path=db_path)
+    pinecone = FakePinecone(DOCS)
+    evidence_index.refresh_questionnaire(pinecone, "qn", QUESTIONS[:1], db_path=db_path)
+    assert answered == ["Q1", "Q1"]
+    assert pinecone.queries == 1
+
+
+def test_question_claimed_by_another_worker_is_skipped_or_awaited(db_path, answered, monkeypatch):
+    monkeypatch.setattr(evidence_index, "CLAIM_POLL_INTERVAL", 0.01)
+    key = evidence_index.question_key(QUESTIONS[0])
+    conn = evidence_index._connect(db_path)
+    assert evidence_index._claim(conn, "qn", key)
+
+    report = evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS[:1],
+                                                  wait_for_others=False, db_path=db_path)
+    assert report == [None]
+    assert answered == []
+
+    # A waiting report job picks the question up once the other worker lets go
+    def release():
+        other_conn = evidence_index._connect(db_path)
+        evidence_index._release(other_conn, "qn", key)
+        other_conn.close()
+
+    threading.Timer(0.1, release).start()
+    report = evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS[:1], db_path=db_path)
+    assert answered == ["Q1"]
+    assert report[0]["question"] == "Q1"
+    conn.close()
+
+
+def test_documents_added_checks_a_whole_file_in_one_pass(db_path, answered):
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS, db_path=db_path)
+    far = [("c0", [0.0, 1.0]), ("c1", [0.0, 2.0])]
+    assert evidence_index.documents_added(far, db_path=db_path) == 0
+    assert evidence_index.documents_added(far + [("c2", [3.0, 0.1])], db_path=db_path) == 2
+    assert evidence_index.documents_added([], db_path=db_path) == 0
+
+
+def test_embeddings_are_stored_as_blobs_and_legacy_json_still_reads(db_path, answered):
+    evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS[:1], db_path=db_path)
+    conn = evidence_index._connect(db_path)
+    try:
+        assert isinstance(conn.execute("SELECT question_embedding FROM question_evidence").fetchone()[0], bytes)
+        conn.execute("UPDATE question_evidence SET question_embedding = ?", ("[1.0, 0.0]",))
+    finally:
+        conn.close()
+    assert evidence_index.document_added("near", [1.0, 0.0], db_path=db_path) == 1
+
+
+def test_failed_write_releases_claim(db_path, answered, monkeypatch):
+    monkeypatch.setattr(evidence_index, "_encode_embedding", lambda embedding: object())
+    with pytest.raises(Exception):
+        evidence_index.refresh_questionnaire(FakePinecone(DOCS), "qn", QUESTIONS[:1], db_path=db_path)
+    conn = evidence_index._connect(db_path)
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM refresh_claims").fetchone()[0] == 0
+    finally:
+        conn.close()
@@ -0,0 +1,82 @@
+import io
+
+import file_processing
+
+
+class UploadedFile(io.BytesIO):
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def test_table_chunks_repeat_header_and_split_blocks(monkeypatch):
+    monkeypatch.setattr(file_processing, "TABLE_ROWS_PER_CHUNK", 2)
+    rows = [(None, None), ("Name", "Qty"), ("a", 1.0), ("b", float("nan")), (None, None), ("c", 3.5)]
+    chunks = list(file_processing._table_chunks("Sheet S", rows))
+    assert [chunk["label"] for chunk in chunks] == ["Sheet S, rows 3-4", "Sheet S, row 6"]
+    assert chunks[0]["text"] == "Sheet S, rows 3-4\nName | Qty\na | 1\nb"
+    assert chunks[1]["text"] == "Sheet S, row 6\nName | Qty\nc | 3.5"
+
+
+def test_cell_separator_is_escaped():
+    chunks = list(file_processing._table_chunks("Sheet S", [("Name", "Val"), ("a", "b|c")]))
+    assert chunks[0]["text"].splitlines()[-1] == "a | b\\|c"
+
+
+def test_xlsx_chunks_cover_every_sheet():
+    import openpyxl
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["Name", "Val"])
+    workbook.active.append(["a", 1])
+    second = workbook.create_sheet("Second")
+    second.append(["Header"])
+    second.append(["x"])
+    data = io.BytesIO()
+    workbook.save(data)
+
+    chunks = file_processing.extract_chunks_from_file(UploadedFile("book.xlsx", data.getvalue()))
+    assert [chunk["label"] for chunk in chunks] == ["Sheet Sheet, row 2", "Sheet Second, row 2"]
+
+
+def _pdf_with_table():
+    # One page: a sentence, a ruled 2x3 table, then another sentence
+    def text(x, y, value):
+        return f"BT /F1 10 Tf {x} {y} Td ({value}) Tj ET"
+
+    ops = [text(20, 270, "Intro paragraph"), text(20, 80, "Closing note")]
+    for y in (210, 180, 150, 120):
+        ops.append(f"20 {y} m 220 {y} l S")
+    for x in (20, 120, 220):
+        ops.append(f"{x} 120 m {x} 210 l S")
+    for y, cells in ((190, ("Name", "Qty")), (160, ("apple", "3")), (130, ("pear|red", "5"))):
+        ops += [text(30, y, cells[0]), text(130, y, cells[1])]
+    stream = "\n".join(ops).encode("latin-1")
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 300 300] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return pdf
+
+
+def test_pdf_table_is_chunked_once_and_cut_from_page_text():
+    chunks = file_processing.extract_chunks_from_file(UploadedFile("report.pdf", _pdf_with_table()))
+    assert [chunk["label"] for chunk in chunks] == [None, "Page 1 table 1, rows 2-3"]
+
+    text = chunks[0]["text"]
+    assert "Intro paragraph" in text and "Closing note" in text
+    assert not any(cell in text for cell in ("Name", "apple", "pear"))
+    assert chunks[1]["text"] == "Page 1 table 1, rows 2-3\nName | Qty\napple | 3\npear\\|red | 5"
@@ -0,0 +1,177 @@
+import time
+
+import pytest
+
+import job_queue
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    job_queue.init_db(path)
+    return path
+
+
+def _claim(db_path):
+    conn = job_queue._connect(db_path)
+    try:
+        return job_queue._claim_next_job(conn)
+    finally:
+        conn.close()
+
+
+def _set_updated_at(db_path, job_id, updated_at):
+    conn = job_queue._connect(db_path)
+    try:
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (updated_at, job_id))
+    finally:
+        conn.close()
+
+
+def _finish(db_path, job_id, status, result=None):
+    conn = job_queue._connect(db_path)
+    try:
+        job_queue._finish_job(conn, job_id, status, result=result)
+    finally:
+        conn.close()
+
+
+def test_submit_dedupes_identical_pending_jobs(db_path):
+    first = job_queue.submit_job("generate_report", {"title": "A", "questions": []}, db_path=db_path)
+    second = job_queue.submit_job("generate_report", {"questions": [], "title": "A"}, db_path=db_path)
+    other = job_queue.submit_job("generate_report", {"title": "B", "questions": []}, db_path=db_path)
+    assert first == second
+    assert other != first
+
+
+def test_submit_dedupes_running_job_unless_disabled(db_path):
+    job_id = job_queue.submit_job("precompute_evidence", {}, db_path=db_path)
+    assert _claim(db_path)["id"] == job_id
+    assert job_queue.submit_job("precompute_evidence", {}, db_path=db_path) == job_id
+    assert job_queue.submit_job("precompute_evidence", {}, dedupe_running=False, db_path=db_path) != job_id
+
+
+def test_submit_queues_new_job_after_previous_finished(db_path):
+    job_id = job_queue.submit_job("precompute_evidence", {}, db_path=db_path)
+    _claim(db_path)
+    _finish(db_path, job_id, job_queue.STATUS_DONE, result={"title": "Evidence index"})
+    assert job_queue.submit_job("precompute_evidence", {}, db_path=db_path) != job_id
+
+
+def test_submit_rejects_unknown_kind(db_path):
+    with pytest.raises(ValueError):
+        job_queue.submit_job("no_such_job", {}, db_path=db_path)
+
+
+def test_claim_takes_oldest_queued_job_once(db_path):
+    first = job_queue.submit_job("generate_report", {"title": "A", "questions": []}, db_path=db_path)
+    second = job_queue.submit_job("generate_report", {"title": "B", "questions": []}, db_path=db_path)
+    assert _claim(db_path)["id"] == first
+    assert _claim(db_path)["id"] == second
+    assert _claim(db_path) is None
+    assert [job["status"] for job in job_queue.get_jobs([first, second], db_path=db_path)] == ["running", "running"]
+
+
+def test_dead_running_job_is_not_deduped_and_is_requeued(db_path):
+    job_id = job_queue.submit_job("precompute_evidence", {}, db_path=db_path)
+    _claim(db_path)
+    _set_updated_at(db_path, job_id, time.time() - job_queue.STALE_JOB_TIMEOUT - 1)
+
+    # Resubmitting doesn't hand back the dead job...
+    new_id = job_queue.submit_job("precompute_evidence", {}, db_path=db_path)
+    assert new_id != job_id
+    # ...and the next claim puts the dead job back in the queue and runs it first
+    assert _claim(db_path)["id"] == job_id
+
+
+def test_job_that_keeps_killing_its_worker_is_failed(db_path):
+    job_id = job_queue.submit_job("precompute_evidence", {}, db_path=db_path)
+    for _ in range(job_queue.MAX_ATTEMPTS):
+        assert _claim(db_path)["id"] == job_id
+        _set_updated_at(db_path, job_id, time.time() - job_queue.STALE_JOB_TIMEOUT - 1)
+    assert _claim(db_path) is None
+    job = job_queue.get_job(job_id, db_path=db_path)
+    assert job["status"] == job_queue.STATUS_FAILED
+    assert "stopped responding" in job["error"]
+
+
+def test_finish_clears_payload_and_prune_removes_old_jobs(db_path):
+    job_id = job_queue.submit_job("generate_report", {"title": "A", "questions": ["x" * 1000]}, db_path=db_path)
+    _claim(db_path)
+    _finish(db_path, job_id, job_queue.STATUS_DONE, result={"report_id": "r1"})
+
+    conn = job_queue._connect(db_path)
+    try:
+        assert conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()["payload"] == "null"
+    finally:
+        conn.close()
+    assert job_queue.get_job(job_id, db_path=db_path)["result"] == {"report_id": "r1"}
+
+    job_queue.prune_finished_jobs(db_path=db_path)
+    assert job_queue.get_job(job_id, db_path=db_path) is not None
+    _set_updated_at(db_path, job_id, time.time() - (job_queue.JOB_RETENTION_DAYS + 1) * 86400)
+    job_queue.prune_finished_jobs(db_path=db_path)
+    assert job_queue.get_job(job_id, db_path=db_path) is None
+
+
+def test_only_current_worker_can_finish_job(db_path):
+    job_id = job_queue.submit_job("precompute_evidence", {}, db_path=db_path)
+    _claim(db_path)
+    # Another worker took the job over after this one was judged dead
+    conn = job_queue._connect(db_path)
+    try:
+        conn.execute("UPDATE jobs SET worker_pid = ? WHERE id = ?", (-1, job_id))
+        assert not job_queue._finish_job(conn, job_id, job_queue.STATUS_FAILED, error="late")
+    finally:
+        conn.close()
+    assert job_queue.get_job(job_id, db_path=db_path)["status"] == job_queue.STATUS_RUNNING
+
+
+class _FakeKnowledgeBase:
+    def __init__(self):
+        self.vectors = {}
+
+    def add_document(self, title, text, embedding, source_id=None, source=None, document_id=None):
+        self.vectors[document_id] = (title, source_id)
+        return document_id
+
+
+def test_retried_ingest_overwrites_the_same_chunks(db_path, monkeypatch):
+    import types
+    import utils
+    import file_processing
+
+    monkeypatch.setattr(utils, "get_embedding", lambda text: [1.0, 0.0])
+    monkeypatch.setattr(file_processing, "extract_chunks_from_file",
+                        lambda f: [{"label": None, "text": "a"}, {"label": "rows 2-3", "text": "b"}])
+    monkeypatch.setattr(job_queue.evidence_index, "documents_added", lambda *args, **kwargs: 0)
+    ctx = types.SimpleNamespace(db_path=db_path, pinecone_connection=_FakeKnowledgeBase())
+    upload = job_queue._JobFile("book.xlsx", b"data")
+
+    payload = job_queue.ingest_payload(upload)
+    assert job_queue.ingest_payload(upload) == payload
+    job_id = job_queue.submit_job("ingest_document", payload, db_path=db_path)
+    first = job_queue._handle_ingest_document(ctx, job_id, payload)
+    again = job_queue._handle_ingest_document(ctx, job_id, payload)
+    assert first == again
+    assert sorted(ctx.pinecone_connection.vectors) == [f"{payload['source_id']}-0", f"{payload['source_id']}-1"]
+
+
+def test_worker_limiter_snapshots_are_shared_until_stale(db_path, monkeypatch):
+    from rate_limiter import OpenAIRateLimiter
+    limiter = OpenAIRateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+    monkeypatch.setattr(job_queue, "get_rate_limiter", lambda: limiter)
+    conn = job_queue._connect(db_path)
+    try:
+        job_queue._record_limiter_metrics(conn)
+    finally:
+        conn.close()
+    [(pid, metrics)] = job_queue.get_limiter_metrics(db_path=db_path)
+    assert metrics["circuit_state"] == "closed"
+
+    conn = job_queue._connect(db_path)
+    try:
+        conn.execute("UPDATE limiter_metrics SET updated_at = ?", (time.time() - job_queue.STALE_JOB_TIMEOUT - 1,))
+    finally:
+        conn.close()
+    assert job_queue.get_limiter_metrics(db_path=db_path) == []
@@ -0,0 +1,16 @@
+import pinecone_integration
+
+
+class FakeIndex:
+    def __init__(self):
+        self.deletes = []
+
+    def delete(self, ids):
+        self.deletes.append(ids)
+
+
+def test_delete_documents_batches_ids(monkeypatch):
+    monkeypatch.setattr(pinecone_integration, "DELETE_BATCH_SIZE", 2)
+    index = FakeIndex()
+    assert pinecone_integration.PineconeConnection(index).delete_documents(["a", "b", "c", "d", "e"])
+    assert index.deletes == [["a", "b"], ["c", "d"], ["e"]]
@@ -0,0 +1,141 @@
+import time
+import threading
+
+import pytest
+
+from rate_limiter import CircuitBreaker, CircuitOpenError, OpenAIRateLimiter, combine_metrics, worker_quota_shares
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class ServerError(Exception):
+    http_status = 503
+
+
+def _fail(limiter, error, estimated_tokens=10):
+    with pytest.raises(type(error)):
+        with limiter.request(estimated_tokens):
+            raise error
+
+
+def test_breaker_opens_after_threshold_and_rejects():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_allows_single_trial_then_closes():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+
+
+def test_breaker_failed_trial_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+
+
+def test_rate_limits_shrink_concurrency_without_opening_circuit():
+    limiter = OpenAIRateLimiter(6000, 100000, max_concurrency=8, failure_threshold=2, rate_limit_cooldown=0)
+    for _ in range(5):
+        _fail(limiter, RateLimitError())
+    assert limiter.breaker.state == CircuitBreaker.CLOSED
+    assert limiter.concurrency.limit == 1
+    assert limiter.metrics()["rate_limited"] == 5
+
+
+def test_server_errors_open_circuit():
+    limiter = OpenAIRateLimiter(6000, 100000, failure_threshold=2, reset_timeout=60)
+    _fail(limiter, ServerError())
+    _fail(limiter, ServerError())
+    with pytest.raises(CircuitOpenError):
+        with limiter.request(10):
+            pass
+
+
+def test_failed_request_refunds_estimated_tokens():
+    limiter = OpenAIRateLimiter(6000, 1000, rate_limit_cooldown=0)
+    _fail(limiter, RateLimitError(), estimated_tokens=800)
+    assert limiter.token_bucket.available() > 900
+
+
+def test_successful_request_charges_reported_usage():
+    limiter = OpenAIRateLimiter(6000, 1000)
+    with limiter.request(100) as report_usage:
+        report_usage(400)
+    assert 590 < limiter.token_bucket.available() < 620
+    assert limiter.metrics()["tokens_used"] == 400
+
+
+def test_wait_for_circuit_blocks_until_trial_window():
+    limiter = OpenAIRateLimiter(6000, 100000, failure_threshold=1, reset_timeout=0.2)
+    _fail(limiter, ServerError())
+    start = time.monotonic()
+    with limiter.request(10, wait_for_circuit=True):
+        pass
+    assert time.monotonic() - start >= 0.15
+    assert limiter.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_concurrency_limit_caps_in_flight_requests():
+    limiter = OpenAIRateLimiter(6000, 100000, max_concurrency=2)
+    assert limiter.concurrency.limit == 1
+    peak = []
+    lock = threading.Lock()
+
+    def call():
+        with limiter.request(10):
+            with lock:
+                peak.append(limiter.concurrency.in_flight)
+            time.sleep(0.02)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 2
+
+
+def test_worker_quota_shares_give_workers_the_bulk():
+    interactive, per_worker = worker_quota_shares(2)
+    assert interactive < per_worker
+    assert interactive + 2 * per_worker == pytest.approx(1.0)
+    assert worker_quota_shares(0) == (1.0, 0.0)
+
+
+def test_combine_metrics_sums_counters_and_keeps_worst_circuit_state():
+    combined = combine_metrics([
+        {"requests": 2, "throttle_wait_seconds": 0.5, "circuit_state": "closed"},
+        {"requests": 3, "throttle_wait_seconds": 1.0, "circuit_state": "open"},
+        {"requests": 1, "throttle_wait_seconds": 0.0, "circuit_state": "half_open"},
+    ])
+    assert combined == {"requests": 6, "throttle_wait_seconds": 1.5, "circuit_state": "open"}
@@ -1,27 +1,49 @@
-import openai
 import logging
-import json
-import re
-import asyncio
-from functools import partial
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 import streamlit as st
 
+from rate_limiter import get_rate_limiter, estimate_tokens
+
 logger = logging.getLogger(__name__)
 
 # Utility function to get secrets
 def get_secret(key, default=None):
     return st.secrets.get(key, default)
 
+# openai is slow to import and not needed for first paint, so it's loaded on first use
+def _get_openai():
+    import openai
+    if not openai.api_key:
+        openai.api_key = get_secret("OPENAI_API_KEY")
+    return openai
+
+# Reserve for the completion when estimating a chat request's token cost up front
+CHAT_COMPLETION_TOKEN_RESERVE = 500
+
+def _response_tokens(response):
+    try:
+        return response['usage']['total_tokens']
+    except (KeyError, TypeError):
+        return None
+
+# Retries go through the shared rate limiter, so they wait for capacity instead of
+# adding to a 429 storm; while the circuit is open they wait for it to let requests through.
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
 def get_embedding(text, model="text-embedding-ada-002"):
-    response = openai.Embedding.create(input=[text], model=model)
+    openai = _get_openai()
+    with get_rate_limiter().request(estimate_tokens(text), wait_for_circuit=True) as report_usage:
+        response = openai.Embedding.create(input=[text], model=model)
+        report_usage(_response_tokens(response))
     embedding = response['data'][0]['embedding']
     return embedding  # The embedding should naturally be 1536 dimensions
 
 def chat_completion(messages, model="gpt-4"):
+    openai = _get_openai()
     try:
-        response = openai.ChatCompletion.create(model=model, messages=messages)
+        estimated_tokens = sum(estimate_tokens(m.get("content", "")) for m in messages) + CHAT_COMPLETION_TOKEN_RESERVE
+        with get_rate_limiter().request(estimated_tokens) as report_usage:
+            response = openai.ChatCompletion.create(model=model, messages=messages)
+            report_usage(_response_tokens(response))
         return response
     except Exception as e:
         logger.error(f"Error in chat completion: {str(e)}")
@@ -78,39 +100,45 @@ def display_questionnaire(questions, prefix=""):
     
     return edited_questions
 
+def answer_question(question, context):
+    prompt = f"""
+    Based on the following context, answer the given question. 
+    If the context doesn't contain relevant information for the question, state that the information is not available.
+
+    Context: {context[:3000]}  # Limiting context to 3000 characters
+
+    Question: {question['question']}
+    Answer: """
+    
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant that generates detailed answers based on given questions and context."},
+        {"role": "user", "content": prompt}
+    ]
+    
+    response = chat_completion(messages)
+    answer = response['choices'][0]['message']['content'].strip()
+    return {
+        "question": question['question'],
+        "answer": answer,
+        "needs_assignment": "information is not available" in answer.lower()
+    }
+
+def answer_error(question, error):
+    logger.error(f"Error generating answer for question '{question['question']}': {str(error)}")
+    return {
+        "question": question['question'],
+        "answer": f"An error occurred while generating the answer: {str(error)}",
+        "needs_assignment": True
+    }
+
 def generate_report(questions, documents, progress_bar):
     context = "\n".join([f"Title: {doc['title']}\n{doc['text']}" for doc in documents])
     
     def process_question(question):
         try:
-            prompt = f"""
-            Based on the following context, answer the given question. 
-            If the context doesn't contain relevant information for the question, state that the information is not available.
-
-            Context: {context[:3000]}  # Limiting context to 3000 characters
-
-            Question: {question['question']}
-            Answer: """
-            
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant that generates detailed answers based on given questions and context."},
-                {"role": "user", "content": prompt}
-            ]
-            
-            response = chat_completion(messages)
-            answer = response['choices'][0]['message']['content'].strip()
-            return {
-                "question": question['question'],
-                "answer": answer,
-                "needs_assignment": "information is not available" in answer.lower()
-            }
+            return answer_question(question, context)
         except Exception as e:
-            logger.error(f"Error generating answer for question '{question['question']}': {str(e)}")
-            return {
-                "question": question['question'],
-                "answer": f"An error occurred while generating the answer: {str(e)}",
-                "needs_assignment": True
-            }
+            return answer_error(question, e)
 
     report = []
     for i, question in enumerate(questions):